@@ -1,16 +1,89 @@
+import functools
 import re
-from collections import namedtuple
-from typing import Any, Union
+from dataclasses import dataclass, replace
+from typing import Any, Optional, Union
 
 import dsp
 from dsp.primitives.demonstrate import Example
 
 from .utils import format_answers, passages2text
 
-Field = namedtuple("Field", "name separator input_variable output_variable description input")
+
+@dataclass(frozen=True)
+class Field:
+    """Metadata for a single prompt field.
+
+    A frozen dataclass rather than a namedtuple: attribute access in the hot
+    query/extract loops goes through the instance dict instead of the
+    namedtuple property descriptors.
+    """
+
+    name: str
+    separator: str
+    input_variable: str
+    output_variable: str
+    description: Optional[str]
+    input: bool
 
 # TODO: de-duplicate with dsp/templates/template.py
 
+# Characters cleaned off the end of extracted segments on newer releases:
+# whitespace plus the `---` separator markers the LM may echo back.
+_TRAILING_MARKER_CHARS = "- \t\n\r"
+
+
+def _default_format(x):
+    """Default handler for fields without a registered format handler."""
+    assert isinstance(x, str), f"Need format_handler for value of type {type(x)}"
+    return " ".join(x.split())
+
+
+_FIELD_ITER_RE = re.compile(r"(?P<name>[^\n]*?)(?P<sep>\s)\{(?P<var>[^}]*)\}(?:\s(?P<desc>[^\n]*\$\{[^\n]*\}))?")
+_ARROW_RE = re.compile(r"(.*) -> (.*)")
+
+
+@functools.lru_cache(maxsize=512)
+def _parse_template(template: str) -> tuple[str, tuple[Field, ...]]:
+    """Parses a raw template string into its instructions and fields.
+
+    Cached so constructing many templates from the same string pays for the
+    regex-driven parse only once; the returned fields tuple is immutable and
+    safe to share across instances.
+    """
+    instructions, _, template = template.partition("\n")
+    template = template.strip()
+
+    fields = []
+    for match in _FIELD_ITER_RE.finditer(template):
+        variable = match.group("var")
+
+        var_match = _ARROW_RE.match(variable)
+        if var_match is not None:
+            input_variable = var_match.group(1)
+            output_variable = var_match.group(2)
+        else:
+            input_variable = variable
+            output_variable = variable
+
+        fields.append(
+            Field(
+                name=match.group("name").lstrip(),
+                separator=match.group("sep"),
+                input_variable=input_variable,
+                output_variable=output_variable,
+                description=match.group("desc"),
+                input=True,
+            ),
+        )
+
+    if not fields:
+        raise ValueError("Could not parse template")
+
+    # The last field is the output the LM is asked to produce.
+    fields[-1] = replace(fields[-1], input=False)
+
+    return instructions, tuple(fields)
+
 
 class TemplateV2:
     def __init__(
@@ -25,48 +98,44 @@ class TemplateV2:
     ):
         self.format_handlers = format_handlers
 
-        template = template.strip()
+        self.instructions, fields = _parse_template(template.strip())
+        self.fields = list(fields)
+        self._guidelines_cache: dict[tuple, str] = {}
+        self._field_specs = None
 
-        self.instructions = re.search("(.*)\n", template).group(1)
-        template = template[len(self.instructions) :].strip()
+    def _get_field_specs(self):
+        """Returns per-field constants used by query(), computed once per instance.
 
-        self.fields = []
-        while len(template) > 0:
-            match = re.search("(.*)(\s){(.*)}\s(.*\${.*})", template)
-            if match is not None:
-                name = match.group(1)
-                separator = match.group(2)
-                variable = match.group(3)
-                description = match.group(4)
-            else:
-                match = re.search("(.*)(\s){(.*)}", template)
-                if match is not None:
-                    name = match.group(1)
-                    separator = match.group(2)
-                    variable = match.group(3)
-                    description = None
-                else:
-                    raise ValueError("Could not parse template")
+        Built lazily because Template (v3) fills in self.fields and
+        self.format_handlers without calling TemplateV2.__init__.
+        """
+        specs = getattr(self, "_field_specs", None)
+        if specs is None:
+            specs = self._field_specs = [
+                (
+                    field.name,
+                    field.separator,
+                    field.separator == " ",
+                    self.format_handlers.get(field.input_variable, _default_format),
+                    field.input_variable,
+                    field.input,
+                )
+                for field in self.fields
+            ]
+        return specs
 
-            var_match = re.match("(.*) -> (.*)", variable)
-            if var_match is not None:
-                input_variable = var_match.group(1)
-                output_variable = var_match.group(2)
-            else:
-                input_variable = variable
-                output_variable = variable
-
-            self.fields.append(
-                Field(
-                    name=name,
-                    separator=separator,
-                    input_variable=input_variable,
-                    output_variable=output_variable,
-                    description=description,
-                ),
-            )
+    def _get_extract_split_re(self):
+        """Returns a compiled alternation over the non-leading field names.
 
-            template = template[len(match.group(0)) :].strip()
+        extract() uses it to segment a raw prediction in a single scan instead
+        of one substring search per field. Built lazily (see _get_field_specs).
+        """
+        split_re = getattr(self, "_extract_split_re", None)
+        if split_re is None:
+            # Longest-first so a name that prefixes another cannot shadow it.
+            names = sorted({field.name for field in self.fields[1:]}, key=len, reverse=True)
+            split_re = self._extract_split_re = re.compile("\n(" + "|".join(map(re.escape, names)) + ")")
+        return split_re
 
     def query(self, example: Example, is_demo: bool = False) -> list[dict[str, Any]]:
         """Retrieves the input variables from the example and formats them into a query string."""
@@ -75,44 +144,43 @@ class TemplateV2:
         # If not a demo, find the last field that doesn't have a value set in `example` and set it to ""
         # This creates the "Output:" prefix at the end of the prompt.
         if not is_demo:
-            has_value = [
-                field.input_variable in example
-                and example[field.input_variable] is not None
-                and example[field.input_variable] != ""
-                for field in self.fields
-            ]
+            # Track the last field with a value in a single pass over the fields.
+            last_valued = -1
+            for i, field in enumerate(self.fields):
+                value = example.get(field.input_variable)
+                if value is not None and value != "":
+                    last_valued = i
 
             # If there are no inputs, set the first field to ""
-            if not any(has_value):
+            if last_valued < 0:
                 example[self.fields[0].input_variable] = ""
-            # Otherwise find the first field without a value.
-            else:
-                for i in range(1, len(has_value)):
-                    if has_value[i - 1] and not any(has_value[i:]):
-                        example[self.fields[i].input_variable] = ""
-                        break
-
-        result_: list[dict[str, Any]] = []
-        for field in self.fields:
-            if field.input_variable in example and example[field.input_variable] is not None:
-                if field.input_variable in self.format_handlers:
-                    format_handler = self.format_handlers[field.input_variable]
+            # Otherwise set the first field after the last one with a value.
+            elif last_valued + 1 < len(self.fields):
+                example[self.fields[last_valued + 1].input_variable] = ""
+
+        # At most one entry per field, so size the buffers up front instead of
+        # growing them append by append.
+        specs = self._get_field_specs()
+        user_parts: list[str] = [""] * len(specs)
+        assistant_parts: list[str] = [""] * len(specs)
+        num_user = num_assistant = 0
+
+        for name, separator, is_space_sep, format_handler, input_variable, is_input in specs:
+            if input_variable in example and example[input_variable] is not None:
+                formatted_value = format_handler(example[input_variable])
+
+                if is_space_sep and "\n" in formatted_value:
+                    separator = "\n"
+
+                if is_input or not is_demo:
+                    user_parts[num_user] = f"{name}{separator}{formatted_value}"
+                    num_user += 1
                 else:
+                    assistant_parts[num_assistant] = f"{name}{separator}{formatted_value}"
+                    num_assistant += 1
 
-                    def format_handler(x):
-                        assert type(x) == str, f"Need format_handler for {field.input_variable} of type {type(x)}"
-                        return " ".join(x.split())
-
-                formatted_value = format_handler(example[field.input_variable])
-                separator = "\n" if field.separator == " " and "\n" in formatted_value else field.separator
-
-                result_.append({
-                    "role": "user" if field.input or not is_demo else "assistant",
-                    "content": f"{field.name}{separator}{formatted_value}"
-                })
-
-        user_content = "\n\n".join([r["content"] for r in result_ if r["role"] == "user"])
-        assistant_content = "\n\n".join([r["content"] for r in result_ if r["role"] == "assistant"])
+        user_content = "\n\n".join(user_parts[:num_user])
+        assistant_content = "\n\n".join(assistant_parts[:num_assistant])
 
         if user_content:
             result.append({"role": "user", "content": user_content})
@@ -122,6 +190,20 @@ class TemplateV2:
 
     def guidelines(self, show_guidelines=True) -> str:
         """Returns the task guidelines as described in the lm prompt"""
+        # The guidelines only depend on the fields and the settings, so cache
+        # them per instance instead of rebuilding the example on every call.
+        key = (show_guidelines, getattr(dsp.settings, "show_guidelines", True))
+
+        cache = getattr(self, "_guidelines_cache", None)
+        if cache is None:
+            cache = self._guidelines_cache = {}
+
+        if key not in cache:
+            cache[key] = self._compute_guidelines(show_guidelines)
+
+        return cache[key]
+
+    def _compute_guidelines(self, show_guidelines=True) -> str:
         if (not show_guidelines) or (hasattr(dsp.settings, "show_guidelines") and not dsp.settings.show_guidelines):
             return ""
 
@@ -136,9 +218,14 @@ class TemplateV2:
         return result
 
     def _has_augmented_guidelines(self):
-        return len(self.fields) > 3 or any(
-            ("\n" in field.separator) or ("\n" in field.description) for field in self.fields
-        )
+        # Depends only on the fields, so compute once per instance (lazily,
+        # see _get_field_specs). Descriptions may be None for parsed templates.
+        augmented = getattr(self, "_augmented_guidelines", None)
+        if augmented is None:
+            augmented = self._augmented_guidelines = len(self.fields) > 3 or any(
+                ("\n" in field.separator) or ("\n" in (field.description or "")) for field in self.fields
+            )
+        return augmented
 
     def extract(
         self,
@@ -167,39 +254,57 @@ class TemplateV2:
         import dspy
 
         idx = min(idx, len(self.fields) - 1)
-        while raw_pred != "" and idx < len(self.fields):
-            if idx < len(self.fields) - 1:
-                next_field_name = "\n" + self.fields[idx + 1].name
-                offset = raw_pred.find(next_field_name)
-
-                if offset >= 0:
-                    if dspy.settings.release >= 20231003:
-                        example[self.fields[idx].output_variable] = raw_pred[:offset].strip().rstrip("---").strip()
-                        raw_pred = raw_pred[offset + len(next_field_name) :].strip().rstrip("---").strip()
-                    else:
-                        example[self.fields[idx].output_variable] = raw_pred[:offset].strip()
-                        raw_pred = raw_pred[offset + len(next_field_name) :].strip()
-
-                    idx += 1
-                else:
-                    if dspy.settings.release >= 20231003:
-                        example[self.fields[idx].output_variable] = raw_pred.strip().rstrip("---").strip()
-                    else:
-                        example[self.fields[idx].output_variable] = raw_pred.strip()
 
-                    raw_pred = ""
-                    idx += 1
-                    break
+        if raw_pred == "":
+            return example
+
+        # The release setting is invariant for the duration of the call, so
+        # resolve the strip behavior once instead of per segment.
+        if dspy.settings.release >= 20231003:
+            def finalize(segment):
+                # One boundary scan per side instead of strip/rstrip/strip.
+                # Leading dashes are kept: only trailing ones are separator
+                # markers, leading ones can be content (lists, negatives).
+                return segment.lstrip().rstrip(_TRAILING_MARKER_CHARS)
+        else:
+            finalize = str.strip
 
+        # Segment the prediction on all candidate field names in one scan,
+        # then walk the segments in field order.
+        if len(self.fields) > 1:
+            parts = self._get_extract_split_re().split(raw_pred)
+        else:
+            parts = [raw_pred]
+
+        content = [parts[0]]
+        advanced = False
+        for i in range(1, len(parts), 2):
+            name = parts[i]
+
+            if idx + 1 < len(self.fields) and name == self.fields[idx + 1].name:
+                # Deliberate change from the old strip-then-find loop: an
+                # empty segment before the expected label assigns "" and
+                # advances to that field. The old loop stripped the remainder
+                # before searching, which ate the label's leading newline and
+                # dumped the label plus everything after it into the current
+                # field, leaving the later fields unset.
+                example[self.fields[idx].output_variable] = finalize("".join(content))
+
+                idx += 1
+                content = [parts[i + 1]]
+                advanced = True
             else:
-                assert idx == len(self.fields) - 1, (idx, len(self.fields))
-
-                if dspy.settings.release >= 20231003:
-                    example[self.fields[idx].output_variable] = raw_pred.strip().rstrip("---").strip()
-                else:
-                    example[self.fields[idx].output_variable] = raw_pred.strip()
-
-                break
+                # Not the next expected field name, so keep it as part of the
+                # current field's content (as the sequential search did).
+                content.append("\n" + name + parts[i + 1])
+
+        # If the final segment cleans away to nothing, leave its output
+        # variable unset so downstream completion checks still treat the
+        # prediction as incomplete. Predictions with no recognized label at
+        # all are assigned as-is, like the old sequential loop did.
+        cleaned = finalize("".join(content))
+        if cleaned != "" or not advanced:
+            example[self.fields[idx].output_variable] = cleaned
 
         return example
 
@@ -213,31 +318,29 @@ class TemplateV2:
         if self.fields[-1].input_variable in example:
             del example[self.fields[-1].input_variable]
 
-        rdemos = [
-            self.query(demo, is_demo=True)
-            for demo in example.demos
-            if (
-                (not demo.get("augmented", False))
-                and (  # validate that the training example has the same primitive input var as the template
-                    self.fields[-1].input_variable in demo and demo[self.fields[-1].input_variable] is not None
-                )
-            )
-        ]
-
-        ademos = [self.query(demo, is_demo=True) for demo in example.demos if demo.get("augmented", False)]
+        # Partition the demos into raw and augmented in a single pass.
+        rdemos = []
+        ademos = []
+        for demo in example.demos:
+            if demo.get("augmented", False):
+                ademos.append(self.query(demo, is_demo=True))
+            elif self.fields[-1].input_variable in demo and demo[self.fields[-1].input_variable] is not None:
+                # validate that the training example has the same primitive input var as the template
+                rdemos.append(self.query(demo, is_demo=True))
 
         # Move the rdemos to ademos if rdemo has all the fields filled in
+        needed_names = [field.name for field in self.fields if field.input_variable in example]
+
+        # Imported here (not at module level) to avoid a circular import.
+        import dspy
+
         rdemos_ = []
         new_ademos = []
-        for rdemo in rdemos:
-            rdemo_content = "\n\n".join([r["content"] for r in rdemo])
-            if all((field.name in rdemo_content) for field in self.fields if field.input_variable in example):
-                import dspy
+        move_to = new_ademos if dspy.settings.release >= 20230928 else ademos
 
-                if dspy.settings.release >= 20230928:
-                    new_ademos.append(rdemo)
-                else:
-                    ademos.append(rdemo)
+        for rdemo in rdemos:
+            if all(any(name in r["content"] for r in rdemo) for name in needed_names):
+                move_to.append(rdemo)
             else:
                 rdemos_.append(rdemo)
 
@@ -0,0 +1,57 @@
+import dsp
+import dspy
+from dsp.templates.template_v2 import TemplateV2
+
+TEMPLATE = (
+    "Answer the question.\n"
+    "Question: {question}\n"
+    "Rationale: {rationale}\n"
+    "Answer: {answer}\n"
+    "Confidence: {confidence}"
+)
+
+
+def test_extract_fills_output_variables():
+    template = TemplateV2(TEMPLATE)
+    raw_pred = "because of X\nAnswer: 42\nConfidence: high"
+    example = template.extract(dsp.Example(question="q"), raw_pred)
+    assert example.rationale == "because of X"
+    assert example.answer == "42"
+    assert example.confidence == "high"
+
+
+def test_extract_empty_labelled_segment_advances():
+    # An empty segment before the next expected label yields "" for that
+    # field and keeps extracting, instead of swallowing the label into the
+    # previous field's content.
+    template = TemplateV2(TEMPLATE)
+    raw_pred = "because of X\nAnswer: \nConfidence: high"
+    for release in (0, 20240101):
+        with dspy.settings.context(release=release):
+            example = template.extract(dsp.Example(question="q"), raw_pred)
+            assert example.rationale == "because of X"
+            assert example.answer == ""
+            assert example.confidence == "high"
+
+
+def test_extract_trailing_marker_segment_leaves_field_unset():
+    # A final segment of separator markers cleans away to nothing on newer
+    # releases, so the output variable stays unset and the completion still
+    # registers as incomplete downstream.
+    template = TemplateV2(TEMPLATE)
+    raw_pred = "because of X\nAnswer:\n  ---"
+    with dspy.settings.context(release=20240101):
+        example = template.extract(dsp.Example(question="q"), raw_pred)
+        assert example.rationale == "because of X"
+        assert "answer" not in example
+    with dspy.settings.context(release=0):
+        example = template.extract(dsp.Example(question="q"), raw_pred)
+        assert example.answer == "---"
+
+
+def test_extract_unlabelled_prediction_goes_to_first_missing_field():
+    template = TemplateV2(TEMPLATE)
+    example = template.extract(dsp.Example(question="q"), "just some text")
+    assert example.rationale == "just some text"
+    assert "answer" not in example
+    assert "confidence" not in example